@@ -4,6 +4,7 @@ import pytz
 import io
 
 import gspread
+from gspread.utils import rowcol_to_a1
 import numpy as np
 import pandas as pd
 import streamlit as st
@@ -24,6 +25,8 @@ from reportlab.platypus import (
 )
 from reportlab.lib.styles import getSampleStyleSheet
 
+from stock_ledger import onhand_after_change, stock_level_row_changes, tracked_invoice_lines
+
 
 south_africa_tz = pytz.timezone('Africa/Johannesburg')
 
@@ -40,6 +43,16 @@ def get_gspread_client():
     return client
 
 
+def get_or_create_worksheet(workbook, title, header):
+    # The inventory sheets are newer than the workbook, so create them with their header row if missing
+    try:
+        return workbook.worksheet(title)
+    except gspread.exceptions.WorksheetNotFound:
+        worksheet = workbook.add_worksheet(title=title, rows=1000, cols=len(header))
+        worksheet.append_row(header)
+        return worksheet
+
+
 @st.cache_data
 def fetch_sheet_data(_sheet, name):
     worksheet = _sheet.get_all_records()
@@ -57,6 +70,18 @@ avonstock = invoice_workbook.worksheet("cp_avonstock")
 detergentstock = invoice_workbook.worksheet("cp_detergentstock")
 shopstock = invoice_workbook.worksheet("cp_shopstock")
 
+stock_level_columns = ["InvoiceType", "StockNo", "OnHand", "ReorderLevel", "TrackedFromId"]
+stock_receipt_columns = ["ReceiptId", "InvoiceType", "StockNo", "ReceiptDate", "Quantity"]
+default_reorder_level = 5
+invoice_type_dict = {
+    'Avon': 1,
+    'Detergents': 2,
+    'Koep en Loep': 3
+}
+
+stockreceipts = get_or_create_worksheet(invoice_workbook, "cp_stockreceipts", stock_receipt_columns)
+stocklevels = get_or_create_worksheet(invoice_workbook, "cp_stocklevels", stock_level_columns)
+
 
 class Production:
     def __init__(self):
@@ -65,6 +90,8 @@ class Production:
         self.avonstock = pd.DataFrame()
         self.detergentstock = pd.DataFrame()
         self.shopstock = pd.DataFrame()
+        self.stockreceipts = pd.DataFrame()
+        self.stocklevels = pd.DataFrame()
         self.today = pd.to_datetime(dt.datetime.now(south_africa_tz).strftime("%Y/%m/%d %H:%M"))
         self.new_status = ""
 
@@ -95,6 +122,17 @@ class Production:
         shopstock_df["StockNo"] = pd.to_numeric(shopstock_df["StockNo"])
         self.shopstock = shopstock_df.copy()
 
+        stockreceipts_df = pd.DataFrame(fetch_sheet_data(stockreceipts, 'stockreceipts'), columns=stock_receipt_columns)
+        stockreceipts_df["ReceiptDate"] = pd.to_datetime(stockreceipts_df["ReceiptDate"], errors="coerce")
+        stockreceipts_df[["ReceiptId", "InvoiceType", "StockNo", "Quantity"]] = stockreceipts_df[["ReceiptId", "InvoiceType", "StockNo", "Quantity"]].apply(pd.to_numeric, errors="coerce").fillna(0)
+        self.stockreceipts = stockreceipts_df.copy()
+
+        stocklevels_df = pd.DataFrame(fetch_sheet_data(stocklevels, 'stocklevels'), columns=stock_level_columns)
+        stocklevels_df = stocklevels_df.apply(pd.to_numeric, errors="coerce")
+        stocklevels_df["ReorderLevel"] = stocklevels_df["ReorderLevel"].fillna(default_reorder_level)
+        stocklevels_df = stocklevels_df.fillna(0)
+        self.stocklevels = stocklevels_df.copy()
+
     def display_data(self):
         self.format_data()
 
@@ -146,9 +184,13 @@ class Production:
                 else:
                     self.add_customer()
             elif avon_navigation == "Stock":
-                avon_stock_radio = st.radio(label="Stock Navigation", options=["All Stock", "Add Stock"])
+                avon_stock_radio = st.radio(label="Stock Navigation", options=["All Stock", "Stock Levels", "Receive Stock", "Add Stock"])
                 if avon_stock_radio == "All Stock":
                     AgGrid(self.avonstock, height=400, key="avon_stock_data")
+                elif avon_stock_radio == "Stock Levels":
+                    self.display_stock_levels(invoice_type_from_store='Avon', stock_type=self.avonstock, aggrid_key="avon_stock_levels")
+                elif avon_stock_radio == "Receive Stock":
+                    self.add_stock_receipt(invoice_type_from_store='Avon', stock_type=self.avonstock)
                 else:
                     self.add_stock(stock_data=self.avonstock, sheet_to_update=avonstock)
 
@@ -167,15 +209,144 @@ class Production:
                 else:
                     self.add_customer()
             elif detergent_navigation == "Stock":
-                detergent_stock_radio = st.radio(label="Customer Navigation", options=["All Stock", "Add Stock"])
+                detergent_stock_radio = st.radio(label="Customer Navigation", options=["All Stock", "Stock Levels", "Receive Stock", "Add Stock"])
                 if detergent_stock_radio == "All Stock":
                     AgGrid(self.detergentstock, height=400, key="detergent_stock_data")
+                elif detergent_stock_radio == "Stock Levels":
+                    self.display_stock_levels(invoice_type_from_store='Detergents', stock_type=self.detergentstock, aggrid_key="detergent_stock_levels")
+                elif detergent_stock_radio == "Receive Stock":
+                    self.add_stock_receipt(invoice_type_from_store='Detergents', stock_type=self.detergentstock)
                 else:
                     self.add_stock(stock_data=self.detergentstock, sheet_to_update=detergentstock)
 
 
         elif sidebar_menu == 'Koep en Loep':
-            st.write('Koep en Loep')
+            shop_navigation = st.radio(label="Navigation", options=["Current Invoices", "Add Invoice", "Customers", "Stock"], horizontal=True)
+
+            if shop_navigation == "Current Invoices":
+                self.update_job(display_df=not_paid_shop_data, status_update="Paid", store_name="Koep en Loep", aggrid_key="shop_data")
+            elif shop_navigation == "Add Invoice":
+                self.add_invoice(invoice_type_from_store='Koep en Loep', stock_type=self.shopstock)
+            elif shop_navigation == "Customers":
+                shop_customer_radio = st.radio(label="Customer Navigation", options=["All Customers", "Add New Customers"])
+                if shop_customer_radio == "All Customers":
+                    AgGrid(self.customers, height=400, key="shop_customer_data")
+                else:
+                    self.add_customer()
+            elif shop_navigation == "Stock":
+                shop_stock_radio = st.radio(label="Stock Navigation", options=["All Stock", "Stock Levels", "Receive Stock", "Add Stock"])
+                if shop_stock_radio == "All Stock":
+                    AgGrid(self.shopstock, height=400, key="shop_stock_data")
+                elif shop_stock_radio == "Stock Levels":
+                    self.display_stock_levels(invoice_type_from_store='Koep en Loep', stock_type=self.shopstock, aggrid_key="shop_stock_levels")
+                elif shop_stock_radio == "Receive Stock":
+                    self.add_stock_receipt(invoice_type_from_store='Koep en Loep', stock_type=self.shopstock)
+                else:
+                    self.add_stock(stock_data=self.shopstock, sheet_to_update=shopstock)
+
+    def adjust_stock_levels(self, invoice_type, stock_changes, start_tracking=False, reorder_level=None):
+        """Applies StockNo -> quantity changes to the affected OnHand cells in cp_stocklevels."""
+        # Read the sheet directly so the balances are never taken from a stale cache
+        levels_df = pd.DataFrame(stocklevels.get_all_records(), columns=stock_level_columns)
+        levels_df = levels_df.apply(pd.to_numeric, errors="coerce").fillna(0)
+        onhand_col = stock_level_columns.index("OnHand") + 1
+        reorder_col = stock_level_columns.index("ReorderLevel") + 1
+
+        row_changes, new_items = stock_level_row_changes(levels_df, invoice_type, stock_changes)
+
+        cell_ranges = [rowcol_to_a1(row, onhand_col) for row in row_changes]
+        cell_updates = []
+        if cell_ranges:
+            current_values = stocklevels.batch_get(cell_ranges, value_render_option="UNFORMATTED_VALUE")
+            for cell_range, cell_values, change in zip(cell_ranges, current_values, row_changes.values()):
+                try:
+                    onhand = onhand_after_change(cell_values, change)
+                except ValueError:
+                    st.error(f"cp_stocklevels cell {cell_range} is not a number, so no stock levels were updated. Fix the cell and apply the change of {change} by hand.")
+                    st.stop()
+                cell_updates.append({"range": cell_range, "values": [[onhand]]})
+        if reorder_level is not None:
+            for row in row_changes:
+                cell_updates.append({"range": rowcol_to_a1(row, reorder_col), "values": [[int(reorder_level)]]})
+        new_rows = []
+        if start_tracking:
+            tracked_from_id = pd.to_numeric(self.invoices["Id"], errors="coerce").max()
+            tracked_from_id = 0 if pd.isna(tracked_from_id) else int(tracked_from_id)
+            new_reorder_level = default_reorder_level if reorder_level is None else int(reorder_level)
+            new_rows = [[int(invoice_type), stock_no, change, new_reorder_level, tracked_from_id] for stock_no, change in new_items.items()]
+
+        if cell_updates:
+            stocklevels.batch_update(cell_updates)
+        if new_rows:
+            if not stocklevels.row_values(1):
+                stocklevels.append_row(stock_level_columns)
+            stocklevels.append_rows(new_rows)
+
+    def add_stock_receipt(self, invoice_type_from_store=None, stock_type=None):
+        st.subheader("Receive Stock")
+
+        stock_data_list = stock_type['StockName'].unique().tolist()
+        stock_data_list.sort()
+
+        st.caption("The first receipt for an item sets its opening stock. Invoices raised before then are not deducted.")
+        with st.form("stock_receipt_form", clear_on_submit=True):
+            fr_col1, fr_col2 = st.columns(2)
+            with fr_col1:
+                item_selected = st.selectbox(label="Stock Item", options=stock_data_list, key="receipt_item")
+            with fr_col2:
+                item_qty = st.number_input("Quantity Received", min_value=1, step=1, key="receipt_qty")
+
+            sr_col1, sr_col2 = st.columns(2)
+            with sr_col1:
+                reorder_level = st.number_input("Reorder Level", min_value=0, step=1, value=None, placeholder="Leave blank to keep current", key="receipt_reorder_level")
+
+            receipt_submit = st.form_submit_button("Receive Stock")
+
+            if receipt_submit:
+                self.format_data()
+                r_list = self.stockreceipts["ReceiptId"].dropna().unique().tolist()
+                r_list.sort()
+                rid = int(r_list[-1]) + 1 if r_list else 1
+
+                invoice_type = invoice_type_dict[invoice_type_from_store]
+                stocknoselection = int(stock_type.loc[stock_type["StockName"] == item_selected, "StockNo"].sum())
+
+                if not stockreceipts.row_values(1):
+                    stockreceipts.append_row(stock_receipt_columns)
+                stockreceipts.append_row([rid, invoice_type, stocknoselection, str(self.today), int(item_qty)])
+                self.adjust_stock_levels(invoice_type, {stocknoselection: int(item_qty)}, start_tracking=True, reorder_level=reorder_level)
+
+                st.success(f"Received {int(item_qty)} x {item_selected}!")
+                st.cache_data.clear()
+                time.sleep(1)
+                st.rerun()
+
+    def display_stock_levels(self, invoice_type_from_store=None, stock_type=None, aggrid_key=None):
+        st.subheader("Stock Levels")
+
+        invoice_type = invoice_type_dict[invoice_type_from_store]
+
+        levels_df = self.stocklevels.loc[self.stocklevels["InvoiceType"] == invoice_type, ["StockNo", "OnHand", "ReorderLevel"]]
+        display_df = stock_type[["StockNo", "StockName"]].merge(levels_df, on="StockNo", how="left")
+        display_df["OnHand"] = display_df["OnHand"].round().astype("Int64")
+        display_df["ReorderLevel"] = display_df["ReorderLevel"].round().astype("Int64")
+        display_df["Status"] = np.where(
+            display_df["OnHand"].isna(),
+            "Untracked",
+            np.where(display_df["OnHand"].fillna(0) <= display_df["ReorderLevel"].fillna(0), "Low", "OK"),
+        )
+        display_df = display_df.sort_values(by="StockName", ascending=True)
+
+        low_stock_df = display_df.loc[display_df["Status"] == "Low"]
+        if not low_stock_df.empty:
+            low_stock_items = ", ".join(f"{row['StockName']} ({row['OnHand']})" for _, row in low_stock_df.iterrows())
+            st.warning(f"Low stock: {low_stock_items}")
+
+        untracked_count = (display_df["Status"] == "Untracked").sum()
+        if untracked_count > 0:
+            st.info(f"{untracked_count} items are untracked. Receive stock for an item to start tracking it.")
+
+        AgGrid(display_df, height=400, key=aggrid_key)
 
     def add_stock(self, stock_data, sheet_to_update):
         st.subheader("Add New Stock")
@@ -283,12 +454,6 @@ class Production:
     def add_invoice(self, invoice_type_from_store=None, stock_type=None):
         st.subheader("Add New Invoice")
 
-        invoice_type_dict = {
-            'Avon': 1,
-            'Detergents': 2,
-            'Koep en Loep': 3
-        }
-
         def create_number_of_items(total_items, stock_data_list):
             item_list = {}
             for _ in range(int(total_items)):
@@ -345,15 +510,16 @@ class Production:
 
                     customerid_selection = customer_temp.loc[customer_temp["FullName"] == customerfullname, "CustomerID"].sum()
                     invoice_type = invoice_type_dict[invoice_type_from_store]
+                    stock_changes = {}
 
                     for item in all_items_ordered.items():
-                        i_list = self.invoices["Id"].unique().tolist()
-                        i_list.sort()
-                        iid = int(i_list[-1]) + 1
+                        # Stay above every TrackedFromId so a reused Id can't be mistaken for an untracked line
+                        iid = int(pd.concat([pd.to_numeric(self.invoices["Id"], errors="coerce"), self.stocklevels["TrackedFromId"]]).max()) + 1
                         stocknoselection = stock_type.loc[stock_type["StockName"] == item[0], "StockNo"].sum()
                         itemqty = item[1][0]
                         unitprice = item[1][1]
                         invoicetotal = unitprice * itemqty
+                        stock_changes[int(stocknoselection)] = stock_changes.get(int(stocknoselection), 0) - int(itemqty)
                         new_job = {
                             "InvoiceNo": [wid],
                             "CustomerID": [customerid_selection],
@@ -374,6 +540,8 @@ class Production:
                             [self.invoices.columns.values.tolist()] + self.invoices.values.tolist()
                         )
 
+                    self.adjust_stock_levels(invoice_type, stock_changes)
+
                     st.success(f"Invoice {wid} added!")
                     st.session_state["reset_invoice_form"] = True
 
@@ -440,19 +608,26 @@ class Production:
             with btn_col2:
                 delete_button = st.button("Delete Invoice")
             if delete_button:
-                for i_id in task_id:
-                    jobs_to_delete = self.invoices.loc[
-                        self.invoices["Id"] == i_id
-                    ].index
-
-                    # Adjust index for Google Sheets (1-based indexing)
-                    rows_to_delete = [
-                        index + 2 for index in jobs_to_delete
-                    ]  # +2 to skip the header row
-
-                    # Delete rows in reverse order to avoid shifting issues
-                    for row in sorted(rows_to_delete, reverse=True):
-                        invoices.delete_rows(row)
+                deleted_df = self.invoices.loc[self.invoices["Id"].isin(task_id)].copy()
+
+                # Adjust index for Google Sheets (1-based indexing)
+                rows_to_delete = [
+                    index + 2 for index in deleted_df.index
+                ]  # +2 to skip the header row
+
+                # Work out the stock to return before deleting, skipping lines raised before the
+                # item was tracked since they were never deducted
+                deleted_df[["InvoiceType", "StockNo", "Quantity", "Id"]] = deleted_df[["InvoiceType", "StockNo", "Quantity", "Id"]].apply(pd.to_numeric, errors="coerce")
+                deleted_df = deleted_df.dropna(subset=["InvoiceType", "StockNo", "Quantity", "Id"])
+                deleted_df = tracked_invoice_lines(deleted_df, self.stocklevels)
+
+                # Delete all selected rows highest first so earlier deletions don't shift later ones
+                for row in sorted(rows_to_delete, reverse=True):
+                    invoices.delete_rows(row)
+
+                for invoice_type, type_df in deleted_df.groupby("InvoiceType"):
+                    stock_changes = type_df.groupby("StockNo")["Quantity"].sum().astype(int).to_dict()
+                    self.adjust_stock_levels(int(invoice_type), stock_changes)
 
                 st.success("Invoice has been deleted")
                 st.cache_data.clear()
@@ -0,0 +1,45 @@
+import pandas as pd
+
+
+def stock_level_row_changes(levels_df, invoice_type, stock_changes):
+    """Splits stock quantity changes into changes to existing cp_stocklevels rows and new items.
+
+    Returns a dict of sheet row number -> quantity change for items that already have a
+    stock level row, and a dict of StockNo -> quantity change for items that do not.
+    """
+    row_changes = {}
+    new_items = {}
+    for stock_no, change in stock_changes.items():
+        if change == 0:
+            continue
+        match = levels_df.loc[(levels_df["InvoiceType"] == invoice_type) & (levels_df["StockNo"] == stock_no)].index
+        if len(match) > 0:
+            # +2 to skip the header row (Google Sheets is 1-based)
+            row = int(match[0]) + 2
+            row_changes[row] = row_changes.get(row, 0) + int(change)
+        else:
+            new_items[int(stock_no)] = new_items.get(int(stock_no), 0) + int(change)
+    return row_changes, new_items
+
+
+def onhand_after_change(cell_values, change):
+    """Adds a quantity change to an OnHand cell as returned by batch_get.
+
+    Raises ValueError if the cell is blank or not a number, rather than overwriting the balance.
+    """
+    onhand = pd.to_numeric(cell_values[0][0] if cell_values and cell_values[0] else None, errors="coerce")
+    if pd.isna(onhand):
+        raise ValueError(f"OnHand value {cell_values!r} is not a number")
+    return int(round(onhand)) + int(change)
+
+
+def tracked_invoice_lines(lines_df, levels_df):
+    """Returns the invoice lines that were deducted from stock.
+
+    An item is only tracked once it has a cp_stocklevels row, and only lines with an Id
+    after that row's TrackedFromId were issued from it.
+    """
+    # Use the first row per item, as stock_level_row_changes does, so duplicate rows don't credit twice
+    levels_df = levels_df.drop_duplicates(["InvoiceType", "StockNo"])
+    tracked_df = lines_df.merge(levels_df[["InvoiceType", "StockNo", "TrackedFromId"]], on=["InvoiceType", "StockNo"], how="inner")
+    return tracked_df.loc[tracked_df["Id"] > tracked_df["TrackedFromId"]].drop(columns="TrackedFromId")